@@ -1,20 +1,49 @@
+import base64
+import collections
+import hashlib
 import json
 from girder import events
 from girder.api import access
 from girder.api.describe import autoDescribeRoute, Description
-from girder.api.rest import filtermodel, RestException
+from girder.api.rest import filtermodel, getCurrentUser, RestException
 from girder.constants import AccessType, TokenScope
 from girder.models.file import File
+from girder.models.folder import Folder
 from girder.models.item import Item
 from girder.plugin import getPlugin, GirderPlugin
 from girder_jobs.models.job import Job
 from girder_worker.docker.tasks import docker_run
-from girder_worker.docker.transforms import VolumePath
+from girder_worker.docker.transforms import BindMountVolume, VolumePath
 from girder_worker.docker.transforms.girder import (
     GirderItemIdToVolume, GirderUploadVolumePathToItem)
 
 _ANGLE_STEP = 20
 _SIZE = 256
+_OUTPUT_DIR = '__thumbnails_output__'
+_PRESETS = ('default', 'CT-AAA', 'CT-Bones', 'CT-Soft-Tissue')
+# Largest initial frame that is inlined into the folder bootstrap response
+_MAX_INLINE_FRAME_SIZE = 64 * 1024
+# Host directory on the worker nodes holding decoded volumes between jobs
+_CACHE_HOST_DIR = '/tmp/interactive_thumbnails_cache'
+_CACHE_CONTAINER_DIR = '/mnt/interactive_thumbnails_cache'
+
+
+def _initialFrameName():
+    # Mirrors the image the web client viewer shows for its default camera
+    # position: theta=90 snapped to the angle step, phi=0.
+    rest = 90 % _ANGLE_STEP
+    theta = 90 + _ANGLE_STEP - rest if rest > _ANGLE_STEP * 0.5 else 90 - rest
+    return '%d_0.jpg' % min(max(theta, 1), 179)
+
+
+def _thumbnailUidPrefix(item):
+    presets = item.get('interactiveThumbnailPresets')
+    return '%s/' % presets[0] if presets else ''
+
+
+def _readFile(file):
+    with File().open(file) as fh:
+        return fh.read()
 
 
 def _handleUpload(event):
@@ -28,16 +57,46 @@ def _handleUpload(event):
     if isinstance(reference, dict) and 'interactive_thumbnail' in reference:
         item = Item().load(file['itemId'], force=True, exc=True)
 
-        file['interactive_thumbnails_uid'] = file['name']
+        if reference.get('preset'):
+            file['interactive_thumbnails_uid'] = '%s/%s' % (reference['preset'], file['name'])
+        else:
+            file['interactive_thumbnails_uid'] = file['name']
         file['attachedToId'] = item['_id']
         file['attachedToType'] = 'item'
         file['itemId'] = None
         File().save(file)
 
+        update = {}
         if not item.get('hasInteractiveThumbnail'):
-            Item().update({'_id': item['_id']}, {'$set': {
-                'hasInteractiveThumbnail': True
-            }}, multi=False)
+            update['hasInteractiveThumbnail'] = True
+
+        # Keep what the folder listing needs on the item itself so that it can
+        # be served without reading thumbnail files.
+        prefix = _thumbnailUidPrefix(item)
+        uid = file['interactive_thumbnails_uid']
+        if uid == prefix + 'index.json':
+            # Stored as a string since manifest keys need not be valid Mongo keys
+            update['interactiveThumbnailManifest'] = _readFile(file).decode('utf8')
+        elif uid == prefix + _initialFrameName() and file['size'] <= _MAX_INLINE_FRAME_SIZE:
+            update['interactiveThumbnailInitialFrame'] = 'data:%s;base64,%s' % (
+                file.get('mimeType') or 'image/jpeg',
+                base64.b64encode(_readFile(file)).decode('ascii'))
+
+        if update:
+            Item().update({'_id': item['_id']}, {'$set': update}, multi=False)
+
+
+def _contentKey(item):
+    """
+    Identify the content of an item's files without downloading them. Uses the
+    hashes computed by the hashsum_download plugin when available, falling back
+    to the file ids and sizes since Girder files are immutable once uploaded.
+    """
+    sha = hashlib.sha256()
+    for file in Item().childFiles(item, sort=[('name', 1)]):
+        sha.update(('%s:%s:%s\n' % (
+            file['name'], file.get('sha512') or file['_id'], file['size'])).encode('utf8'))
+    return sha.hexdigest()
 
 
 def _removeThumbnails(item, saveItem=False):
@@ -50,10 +109,23 @@ def _removeThumbnails(item, saveItem=False):
     if saveItem:
         Item().update(
             {'_id': item['_id']},
-            {'$set': {'hasInteractiveThumbnail': False}},
+            {'$set': {'hasInteractiveThumbnail': False},
+             '$unset': {'interactiveThumbnailManifest': True,
+                        'interactiveThumbnailInitialFrame': True}},
             multi=False)
 
 
+def _downloadThumbnail(item, uid):
+    file = File().findOne({
+        'attachedToId': item['_id'],
+        'interactive_thumbnails_uid': uid
+    })
+    if not file:
+        raise RestException('No such thumbnail for uid "%s".' % uid)
+
+    return File().download(file)
+
+
 @access.cookie
 @access.public(scope=TokenScope.DATA_READ)
 @autoDescribeRoute(
@@ -62,14 +134,53 @@ def _removeThumbnails(item, saveItem=False):
     .param('uid', 'The UID (path) of the thumbnail file to retrieve.', paramType='path')
 )
 def _getThumbnail(item, uid):
-    file = File().findOne({
-        'attachedToId': item['_id'],
-        'interactive_thumbnails_uid': uid
-    })
-    if not file:
-        raise RestException('No such thumbnail for uid "%s".' % uid)
+    return _downloadThumbnail(item, uid)
 
-    return File().download(file)
+
+@access.cookie
+@access.public(scope=TokenScope.DATA_READ)
+@autoDescribeRoute(
+    Description('Download an interactive thumbnail image rendered with a given preset.')
+    .modelParam('id', model=Item, level=AccessType.READ)
+    .param('preset', 'The transfer function preset the thumbnail was rendered with.',
+           paramType='path')
+    .param('uid', 'The UID (path) of the thumbnail file to retrieve.', paramType='path')
+)
+def _getPresetThumbnail(item, preset, uid):
+    return _downloadThumbnail(item, '%s/%s' % (preset, uid))
+
+
+@access.public(scope=TokenScope.DATA_READ)
+@autoDescribeRoute(
+    Description('Get a page of the items of a folder along with everything needed to '
+                'display their interactive thumbnails.')
+    .notes('Returns the folder with its item count and the page of items. Each item '
+           'includes its thumbnail manifest and, optionally, its initial frame inlined '
+           'as a data URI, so no further requests are needed to render the page.')
+    .modelParam('id', model=Folder, level=AccessType.READ)
+    .param('includeFrames', 'Whether to inline the initial frame of each thumbnail.',
+           dataType='boolean', default=False, required=False)
+    .pagingParams(defaultSort='lowerName')
+)
+def _listFolderThumbnails(folder, includeFrames, limit, offset, sort):
+    user = getCurrentUser()
+    # Initial frames can be large, only read them from the database when needed
+    fields = None if includeFrames else {'interactiveThumbnailInitialFrame': False}
+
+    items = []
+    for item in Folder().childItems(
+            folder, limit=limit, offset=offset, sort=sort, fields=fields):
+        doc = Item().filter(item, user)
+        if item.get('interactiveThumbnailManifest'):
+            doc['interactiveThumbnailManifest'] = json.loads(item['interactiveThumbnailManifest'])
+        if includeFrames and item.get('interactiveThumbnailInitialFrame'):
+            doc['interactiveThumbnailInitialFrame'] = item['interactiveThumbnailInitialFrame']
+        items.append(doc)
+
+    return {
+        'folder': dict(Folder().filter(folder, user), nItems=Folder().countItems(folder)),
+        'items': items
+    }
 
 
 @access.user(scope=TokenScope.DATA_WRITE)
@@ -78,26 +189,56 @@ def _getThumbnail(item, uid):
     Description('Generate a new set of interactive thumbnail images for an item.')
     .modelParam('id', model=Item, level=AccessType.WRITE)
     .param('preset', 'Volume rendering transfer function preset to use.',
-           default='default', enum=('default', 'CT-AAA', 'CT-Bones', 'CT-Soft-Tissue'))
+           default='default', enum=_PRESETS)
+    .jsonParam('presets', 'A JSON list of transfer function presets to render in one job. '
+               'Overrides "preset" when given.', requireArray=True, required=False)
+    .param('mapper', 'Volume mapper to render with. "auto" uses the multithreaded CPU '
+           'ray caster on workers without hardware OpenGL.', default='auto',
+           enum=('auto', 'gpu', 'cpu-fixed-point', 'smart'))
+    .param('threads', 'Number of threads for CPU ray casting, defaults to all cores.',
+           dataType='integer', required=False)
 )
-def _createThumbnail(item, preset):
+def _createThumbnail(item, preset, presets, mapper, threads):
+    if threads is not None and threads < 1:
+        raise RestException('The number of threads must be at least 1.')
+    # Drop duplicates, keeping the requested order
+    presets = list(collections.OrderedDict.fromkeys(presets or [preset]))
+    for p in presets:
+        if p not in _PRESETS:
+            raise RestException('Invalid preset "%s", must be one of: %s.' % (
+                p, ', '.join(_PRESETS)))
+
     # Remove previously attached thumbnails
     _removeThumbnails(item, saveItem=True)
+    Item().update({'_id': item['_id']}, {'$set': {
+        'interactiveThumbnailPresets': presets
+    }}, multi=False)
+
+    outdir = VolumePath(_OUTPUT_DIR)
+    args = [
+        '--angle-step', str(_ANGLE_STEP),
+        '--width', str(_SIZE),
+        '--height', str(_SIZE),
+        '--mapper', mapper,
+        '--cache-dir', _CACHE_CONTAINER_DIR,
+        '--cache-key', _contentKey(item)
+    ]
+    if threads:
+        args += ['--threads', str(threads)]
+    for p in presets:
+        args += ['--preset', p]
 
-    outdir = VolumePath('__thumbnails_output__')
     return docker_run.delay(
-        'zachmullen/3d_thumbnails:latest', container_args=[
-            '--angle-step', str(_ANGLE_STEP),
-            '--width', str(_SIZE),
-            '--height', str(_SIZE),
-            '--preset', preset,
+        'zachmullen/3d_thumbnails:latest', container_args=args + [
             GirderItemIdToVolume(item['_id'], item_name=item['name']),
             outdir
-        ], girder_job_title='Interactive thumbnail generation: %s' % item['name'],
+        ], volumes=[BindMountVolume(_CACHE_HOST_DIR, _CACHE_CONTAINER_DIR)],
+        girder_job_title='Interactive thumbnail generation: %s' % item['name'],
         girder_result_hooks=[
-            GirderUploadVolumePathToItem(outdir, item['_id'], upload_kwargs={
-                'reference': json.dumps({'interactive_thumbnail': True})
-            })
+            GirderUploadVolumePathToItem(
+                VolumePath('%s/%s' % (_OUTPUT_DIR, p)), item['_id'], upload_kwargs={
+                    'reference': json.dumps({'interactive_thumbnail': True, 'preset': p})
+                }) for p in presets
         ]).job
 
 
@@ -113,7 +254,12 @@ class InteractiveThumbnailsPlugin(GirderPlugin):
         File().ensureIndex(
             ([('interactive_thumbnails_uid', 1), ('attachedToId', 1)], {'sparse': True}))
         File().exposeFields(level=AccessType.READ, fields={'interactive_thumbnails_info'})
-        Item().exposeFields(level=AccessType.READ, fields={'hasInteractiveThumbnail'})
+        Item().exposeFields(level=AccessType.READ, fields={
+            'hasInteractiveThumbnail', 'interactiveThumbnailPresets'})
 
         info['apiRoot'].item.route('GET', (':id', 'interactive_thumbnail', ':uid'), _getThumbnail)
+        info['apiRoot'].item.route(
+            'GET', (':id', 'interactive_thumbnail', ':preset', ':uid'), _getPresetThumbnail)
         info['apiRoot'].item.route('POST', (':id', 'interactive_thumbnail'), _createThumbnail)
+        info['apiRoot'].folder.route(
+            'GET', (':id', 'interactive_thumbnails'), _listFolderThumbnails)
@@ -0,0 +1,47 @@
+import _ from 'underscore';
+import FolderModel from 'girder/models/FolderModel';
+import ItemCollection from 'girder/collections/ItemCollection';
+import { restRequest } from 'girder/rest';
+
+/**
+ * Items of a folder, fetched along with the folder itself, their thumbnail
+ * manifests and inlined initial frames so a page of viewers renders from a
+ * single request.
+ */
+const ThumbnailItemCollection = ItemCollection.extend({
+    initialize: function (models, options) {
+        this.folder = new FolderModel({_id: options.folderId});
+    },
+
+    // Same paging behavior as the base collection, but the endpoint also
+    // returns the folder and its item count along with the page.
+    fetch: function (params, reset) {
+        this.params = params || {};
+        if (reset) {
+            this.offset = 0;
+        }
+
+        return restRequest({
+            url: `folder/${this.folder.id}/interactive_thumbnails`,
+            data: _.extend({
+                limit: this.pageLimit + 1,
+                offset: this.offset,
+                sort: this.sortField,
+                sortdir: this.sortDir
+            }, this.params)
+        }).done((resp) => {
+            const list = resp.items;
+            this._hasMorePages = list.length > this.pageLimit;
+            if (this._hasMorePages) {
+                list.pop();
+            }
+            this.offset += list.length;
+
+            this.folder.set(resp.folder);
+            this.reset(list);
+            this.trigger('g:changed');
+        });
+    }
+});
+
+export default ThumbnailItemCollection;
@@ -1,28 +1,24 @@
 import $ from 'jquery';
 import { Layout } from 'girder/constants';
 import events from 'girder/events';
-import FolderModel from 'girder/models/FolderModel';
 import ItemModel from 'girder/models/ItemModel';
 import HierarchyWidget from 'girder/views/widgets/HierarchyWidget';
-import ItemCollection from 'girder/collections/ItemCollection';
 import router from 'girder/router';
 import { wrap } from 'girder/utilities/PluginUtils'
 
+import ThumbnailItemCollection from './collections/ThumbnailItemCollection';
 import FolderListView from './folderListView/FolderListView';
 import folderActionsExt from './folderActionsExt.pug';
 
 
 router.route('folder/:id/interactive_thumbnails', (id) => {
-    const items = new ItemCollection();
-    const folder = new FolderModel({
-        _id: id
-    });
+    const items = new ThumbnailItemCollection([], {folderId: id});
 
     items.pageLimit = 30;  // Choose page size with nice divisors for flow layout
 
-    $.when(folder.fetch(), folder.fetch({extraPath: 'details'}), items.fetch({folderId: id})).then(() => {
+    items.fetch({includeFrames: true}).then(() => {
         events.trigger('g:navigateTo', FolderListView, {
-            folder,
+            folder: items.folder,
             items
         }, {renderNow: true});
     });
@@ -70,7 +70,7 @@ const newViewUp = new Float64Array(3);
 // ----------------------------------------------------------------------------
 
 export default class CinemaThumbnail {
-  constructor(el, basepath, angleStep) {
+  constructor(el, basepath, angleStep, initialImage) {
     this.container = el;
     this.basepath = basepath;
     this.angleStep = angleStep;
@@ -110,7 +110,13 @@ export default class CinemaThumbnail {
     // Reload state if available
     this.setState(el.dataset.state);
 
-    this.updateImage();
+    if (initialImage && !el.dataset.state) {
+      // Inlined frame for the default camera position, no request needed
+      this.image.src = initialImage;
+      this.image.dataset.state = this.getState();
+    } else {
+      this.updateImage();
+    }
   }
 
   free() {
@@ -1,3 +1,4 @@
+import $ from 'jquery';
 import View from 'girder/views/View';
 import { getApiRoot } from 'girder/rest';
 
@@ -7,15 +8,32 @@ import './viewerWidget.styl';
 
 const ViewerWidget = View.extend({
     className: 'g-interactive-thumbnail-viewer-container',
+    events: {
+        'change .g-interactive-thumbnail-preset': function (e) {
+            // All presets are generated up front, switching only changes the image path
+            this._thumbnail.basepath = this._basepath($(e.currentTarget).val());
+            this._thumbnail.updateImage();
+        }
+    },
+
     render: function () {
-        this.$el.html(template());
-        new CinemaThumbnail(
+        // Thumbnails generated before presets were namespaced have no preset list
+        const presets = this.model.get('interactiveThumbnailPresets') || [];
+
+        this.$el.html(template({presets}));
+        this._thumbnail = new CinemaThumbnail(
             this.$('.g-interactive-thumbnail-viewer')[0],
-            `${getApiRoot()}/item/${this.model.id}/interactive_thumbnail`,
-            20).updateImage();
+            this._basepath(presets[0]),
+            20,
+            this.model.get('interactiveThumbnailInitialFrame'));
 
         return this;
     },
+
+    _basepath: function (preset) {
+        const basepath = `${getApiRoot()}/item/${this.model.id}/interactive_thumbnail`;
+        return preset ? `${basepath}/${encodeURIComponent(preset)}` : basepath;
+    }
 });
 
 export default ViewerWidget;
@@ -1,11 +1,16 @@
 #!/usr/bin/env python
 
 import click
+import collections
 import itk
+import hashlib
 import itkTemplate
 import json
 import math
+import numpy
 import os
+import pydicom
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 
 
 __version__ = '0.1.0'
@@ -15,25 +20,19 @@ DEFAULT_NB_SLICES = 10
 INPUT_IMAGE_DIMENSION = 3
 SLICING_DIMENSION = 2
 OUTPUT_IMAGE_DIMENSION = 2
+SERIES_INDEX_FILE = '.series_index.json'
+SERIES_INDEX_VERSION = 2
+SERIES_INDEX_TAGS = ['SeriesInstanceUID', 'SeriesDate', 'ImagePositionPatient',
+                     'ImageOrientationPatient', 'InstanceNumber', 'Rows', 'Columns']
+DEFAULT_SERIES_INDEX_DIR = os.path.join(
+    os.path.expanduser('~'), '.cache', 'dicom_series_index')
 
 
-def smooth_and_resample(image, width, height):
-    # Set input image origin to 0,0 as we do not want to worry about it.
-    image.SetOrigin([0, 0])
-
-    original_size = itk.size(image)
-    original_spacing = image.GetSpacing()
-
-    # We need to create a new Python variable to compute
-    # the new size as `size_im` that was returned above is
-    # actually a reference that points to the value that is
-    # contained in the image.
-    new_size = itk.Size[OUTPUT_IMAGE_DIMENSION]()
-    new_size[0] = width
-    new_size[1] = height
+def compute_output_spacing(original_size, original_spacing, width, height):
     SpacingType = itk.Vector[itk.D, OUTPUT_IMAGE_DIMENSION]
     scale = SpacingType()
     new_spacing = SpacingType()
+    new_size = (width, height)
     for ii in range(OUTPUT_IMAGE_DIMENSION):
         scale[ii] = float(original_size[ii])/float(new_size[ii])
         new_spacing[ii] = scale[ii]*original_spacing[ii]
@@ -50,6 +49,22 @@ def smooth_and_resample(image, width, height):
     for ii in [0, 1]:
         sigma[ii] = 2*new_spacing[ii]/math.pi
     variance = sigma*sigma
+    return new_spacing, variance
+
+
+def smooth_and_resample(image, width, height):
+    # Set input image origin to 0,0 as we do not want to worry about it.
+    image.SetOrigin([0, 0])
+
+    # We need to create a new Python variable to compute
+    # the new size as `size_im` that was returned above is
+    # actually a reference that points to the value that is
+    # contained in the image.
+    new_size = itk.Size[OUTPUT_IMAGE_DIMENSION]()
+    new_size[0] = width
+    new_size[1] = height
+    new_spacing, variance = compute_output_spacing(
+        itk.size(image), image.GetSpacing(), width, height)
 
     gaussian_image = itk.DiscreteGaussianImageFilter(
         image, UseImageSpacing=True, Variance=variance)
@@ -106,19 +121,138 @@ def ImageSeriesReader(*args, **kwargs):
     return ReaderType.New(*args, **kwargs)
 
 
-def get_filenames(in_dir):
-    nameGenerator = itk.GDCMSeriesFileNames.New()
-    # In case multiple series. Probably not necessary
-    nameGenerator.SetUseSeriesDetails(True)
-    # Limit series by date
-    nameGenerator.AddSeriesRestriction("0008|0021")
+def read_series_header(file_name):
+    """
+    Read only the tags needed to group and order a DICOM file within its series.
+    Parsing stops before the pixel data. Returns None for non-DICOM files.
+    """
+    try:
+        # Like GDCM, accept files without the preamble and DICM marker. Files
+        # that are not DICOM at all have no SeriesInstanceUID.
+        ds = pydicom.dcmread(file_name, stop_before_pixels=True, force=True,
+                             specific_tags=SERIES_INDEX_TAGS)
+        if 'SeriesInstanceUID' not in ds:
+            return None
+
+        position = ds.get('ImagePositionPatient')
+        orientation = ds.get('ImageOrientationPatient')
+        instance = ds.get('InstanceNumber')
+        rows = ds.get('Rows')
+        columns = ds.get('Columns')
+        return {
+            'series_uid': str(ds.SeriesInstanceUID),
+            'series_date': str(ds.get('SeriesDate') or ''),
+            'position': [float(v) for v in position] if position else None,
+            'orientation': [float(v) for v in orientation] if orientation else None,
+            'instance': int(instance) if instance not in (None, '') else None,
+            'rows': int(rows) if rows not in (None, '') else None,
+            'columns': int(columns) if columns not in (None, '') else None
+        }
+    except Exception:
+        # Skip unreadable or damaged files rather than failing the whole
+        # discovery, like GDCM does.
+        return None
+
+
+def _series_group_key(header):
+    # Like GDCM's series details, files of a series that differ in date,
+    # orientation or image size cannot be stacked into a single volume.
+    orientation = header['orientation']
+    return (header['series_uid'], header['series_date'],
+            tuple(round(v, 4) for v in orientation) if orientation else None,
+            header['rows'], header['columns'])
+
+
+def _slice_sort_key(name, header):
+    # Order slices along the normal of the image plane like GDCM does,
+    # falling back on the instance number and then the file name.
+    if header['position'] and header['orientation']:
+        normal = numpy.cross(header['orientation'][:3], header['orientation'][3:])
+        return (0, float(numpy.dot(normal, header['position'])), name)
+    if header['instance'] is not None:
+        return (1, header['instance'], name)
+    return (2, 0, name)
+
+
+def index_series(in_dir, index_dir=DEFAULT_SERIES_INDEX_DIR, workers=None):
+    """
+    Group the DICOM files of a directory into stackable series, keyed by
+    `_series_group_key`. Headers are read in parallel, and the result is
+    persisted in a small JSON index keyed by the modification times and sizes
+    of the files so that only new or changed files are read again on
+    subsequent runs. The index is kept in `index_dir`, or next to the input
+    files if `index_dir` is None.
+    """
+    stats = {}
+    for name in sorted(os.listdir(in_dir)):
+        path = os.path.join(in_dir, name)
+        if os.path.isfile(path):
+            st = os.stat(path)
+            stats[name] = [st.st_mtime, st.st_size]
+
+    if index_dir is None:
+        index_file = os.path.join(in_dir, SERIES_INDEX_FILE)
+    else:
+        index_file = os.path.join(index_dir, '%s.json' % hashlib.sha1(
+            os.path.abspath(in_dir).encode('utf8')).hexdigest())
+    try:
+        with open(index_file) as f:
+            index = json.load(f)
+        if index.get('version') != SERIES_INDEX_VERSION:
+            index = {}
+    except (IOError, OSError, ValueError):
+        index = {}
+
+    files = {name: entry for name, entry in index.get('files', {}).items()
+             if stats.get(name) == entry['stat']}
+    stale = [name for name in stats if name not in files and name != SERIES_INDEX_FILE]
+
+    if stale:
+        with ProcessPoolExecutor(max_workers=workers or os.cpu_count()) as executor:
+            headers = executor.map(
+                read_series_header, [os.path.join(in_dir, name) for name in stale],
+                chunksize=16)
+            for name, header in zip(stale, headers):
+                files[name] = {'stat': stats[name], 'header': header}
+
+        index = {'version': SERIES_INDEX_VERSION, 'files': files}
+        try:
+            if index_dir is not None and not os.path.exists(index_dir):
+                os.makedirs(index_dir)
+            with open(index_file, 'w') as f:
+                json.dump(index, f)
+        except (IOError, OSError):
+            # The index is only an optimization, e.g. the input may be read-only
+            pass
+
+    series = {}
+    for name, entry in files.items():
+        header = entry['header']
+        if header is not None:
+            series.setdefault(_series_group_key(header), []).append((name, header))
+
+    return {
+        key: [os.path.join(in_dir, name)
+              for name, header in sorted(entries, key=lambda e: _slice_sort_key(*e))]
+        for key, entries in series.items()
+    }
+
+
+def get_filenames(in_dir, series_uid=None, index_dir=DEFAULT_SERIES_INDEX_DIR,
+                  workers=None):
+    series = index_series(in_dir, index_dir, workers)
+    if not series:
+        raise Exception("No DICOM series found in %s." % in_dir)
+
+    candidates = [key for key in series if series_uid is None or key[0] == series_uid]
+    if not candidates:
+        raise Exception("Series %s not found. Available series: %s." % (
+            series_uid, ', '.join(sorted({key[0] for key in series}))))
 
-    nameGenerator.SetDirectory(in_dir)
-    # TODO: See if it is better to keep only the first series or throw
-    # an error message if multiple series are found.
-    seriesIdentifier = nameGenerator.GetSeriesUIDs()
-    fileNames = nameGenerator.GetFileNames(seriesIdentifier[0])
-    return fileNames
+    # Several series can be mixed in a study, and a series can be split by
+    # orientation or image size. Keep the largest stackable group.
+    key = max(candidates, key=lambda k: (len(series[k]), str(k)))
+    return series[key]
 
 
 def rescale_dicom_image_intensity(image, meta_dict):
@@ -157,6 +291,59 @@ def save_as_jpeg(image, out_dir, current_slice):
                 output_image_filename)
 
 
+def smooth_and_resample_slices(image, slice_indices, width, height):
+    """
+    Smooth and resample the given slices of a 3D image all at once. The slices
+    are stacked into a new 3D image with unit spacing along the slicing
+    dimension so that a single Gaussian filter (restricted to the in-plane
+    dimensions) and a single resampling filter process every slice.
+    """
+    # Copy only the selected (slice, row, column) planes out of the image buffer
+    stack = numpy.ascontiguousarray(
+        itk.array_view_from_image(image)[list(slice_indices)])
+    stack_image = itk.image_view_from_array(stack)
+
+    input_spacing = image.GetSpacing()
+    new_spacing, variance = compute_output_spacing(
+        itk.size(image), input_spacing, width, height)
+    stack_image.SetSpacing([input_spacing[0], input_spacing[1], 1.0])
+
+    InputVectorType = itk.Vector[itk.D, INPUT_IMAGE_DIMENSION]
+    stack_variance = InputVectorType()
+    output_spacing = InputVectorType()
+    output_size = itk.Size[INPUT_IMAGE_DIMENSION]()
+    for ii in range(OUTPUT_IMAGE_DIMENSION):
+        stack_variance[ii] = variance[ii]
+        output_spacing[ii] = new_spacing[ii]
+    stack_variance[SLICING_DIMENSION] = 0
+    output_spacing[SLICING_DIMENSION] = 1.0
+    output_size[0] = width
+    output_size[1] = height
+    output_size[SLICING_DIMENSION] = len(slice_indices)
+
+    gaussian_filter = itk.DiscreteGaussianImageFilter.New(
+        stack_image, UseImageSpacing=True, Variance=stack_variance)
+    # Do not smooth across slices
+    gaussian_filter.SetFilterDimensionality(OUTPUT_IMAGE_DIMENSION)
+    resampled_image = itk.ResampleImageFilter(
+        gaussian_filter.GetOutput(), Size=output_size, OutputSpacing=output_spacing)
+
+    # Plain conversion to unsigned char, like `CastImageFilter` in the
+    # per-slice path. Values are already within [0, 255] after rescaling.
+    return itk.array_from_image(resampled_image).astype(numpy.uint8)
+
+
+def save_slices_as_jpeg(slices, out_dir, slice_indices, workers=None):
+    def _write(args):
+        array, current_slice = args
+        output_image_filename = os.path.join(out_dir, '%d.jpg' % current_slice)
+        itk.imwrite(itk.image_from_array(array), output_image_filename)
+
+    with ThreadPoolExecutor(max_workers=workers or os.cpu_count()) as executor:
+        # Consume the results so that errors are raised here
+        list(executor.map(_write, zip(slices, slice_indices)))
+
+
 def generate_json(out_dir, list_indices):
     json_dict = {
         "arguments_order": [
@@ -224,8 +411,14 @@ def compute_real_width_and_height(image, width, height):
 @click.option('--width', type=click.INT, default=None, help='output image width (px)')  # noqa
 @click.option('--height', type=click.INT, default=None, help='output image height (px)')  # noqa
 @click.option('--slices', type=click.INT, default=DEFAULT_NB_SLICES, help='number of slicer step for sampling (degrees)')  # noqa
+@click.option('--batch/--no-batch', default=True, help='resample all slices at once with NumPy instead of one filter pipeline per slice')  # noqa
+@click.option('--workers', type=click.INT, default=None, help='number of workers used to read DICOM headers and encode JPEG files (default: number of CPUs)')  # noqa
+@click.option('--series-uid', default=None, help='SeriesInstanceUID of the series to process (default: largest series)')  # noqa
+@click.option('--index-dir', type=click.Path(file_okay=False), default=DEFAULT_SERIES_INDEX_DIR, help='directory in which to keep the DICOM series index')  # noqa
+@click.option('--index-in-input', is_flag=True, help='keep the DICOM series index in IN_DIR instead of --index-dir')  # noqa
 @click.version_option(version=__version__, prog_name='Create 2D thumbnails from 3D image.')  # noqa
-def process(in_dir, out_dir, width, height, slices):
+def process(in_dir, out_dir, width, height, slices, batch, workers, series_uid,
+            index_dir, index_in_input):
 
     if not slices >= 2:
         raise Exception("`slices` must me greater or equal to 1.")
@@ -233,7 +426,8 @@ def process(in_dir, out_dir, width, height, slices):
     if not os.path.exists(out_dir):
         os.makedirs(out_dir)
 
-    file_names = get_filenames(in_dir)
+    file_names = get_filenames(
+        in_dir, series_uid, None if index_in_input else index_dir, workers)
     dicom_reader = ImageSeriesReader(FileNames=file_names)
     dicom_reader.MetaDataDictionaryArrayUpdateOn()
     dicom_reader.Update()
@@ -266,34 +460,41 @@ def process(in_dir, out_dir, width, height, slices):
 
     size_sampling_dim = image_size[SLICING_DIMENSION]
 
-    region = itk.ImageRegion[INPUT_IMAGE_DIMENSION]()
-    new_size = itk.Size[INPUT_IMAGE_DIMENSION]()
-    image_index = itk.Index[INPUT_IMAGE_DIMENSION]()
-
-    for ii in range(INPUT_IMAGE_DIMENSION-1):
-        new_size[ii] = image_size[ii]
-    new_size[INPUT_IMAGE_DIMENSION-1] = 0
-
-    region.SetSize(new_size)
-    CollapsedImageType = itk.Image[itk.template(
-        rescaled_image)[1][0], OUTPUT_IMAGE_DIMENSION]
-
-    list_indices = []
-    for ii in range(slices):
-        slice_index = int((size_sampling_dim-1)*ii/(slices-1))
-        image_index[SLICING_DIMENSION] = slice_index
-        list_indices.append(slice_index)
-
-        region.SetIndex(image_index)
-        slice_image_filter = itk.ExtractImageFilter[
-            rescaled_image, CollapsedImageType].New(
-            rescaled_image, ExtractionRegion=region)
-        slice_image_filter.SetDirectionCollapseToIdentity()
-        slice_image_filter.Update()
-
-        resampled_image = smooth_and_resample(slice_image_filter.GetOutput(),
-                                              width, height)
-        save_as_jpeg(resampled_image, out_dir, slice_index)
+    # Requesting more slices than the image has yields repeated indices, each
+    # slice is only processed and written once.
+    list_indices = list(collections.OrderedDict.fromkeys(
+        int((size_sampling_dim-1)*ii/(slices-1)) for ii in range(slices)))
+
+    if batch:
+        resampled_slices = smooth_and_resample_slices(
+            rescaled_image, list_indices, width, height)
+        save_slices_as_jpeg(resampled_slices, out_dir, list_indices, workers)
+    else:
+        region = itk.ImageRegion[INPUT_IMAGE_DIMENSION]()
+        new_size = itk.Size[INPUT_IMAGE_DIMENSION]()
+        image_index = itk.Index[INPUT_IMAGE_DIMENSION]()
+
+        for ii in range(INPUT_IMAGE_DIMENSION-1):
+            new_size[ii] = image_size[ii]
+        new_size[INPUT_IMAGE_DIMENSION-1] = 0
+
+        region.SetSize(new_size)
+        CollapsedImageType = itk.Image[itk.template(
+            rescaled_image)[1][0], OUTPUT_IMAGE_DIMENSION]
+
+        for slice_index in list_indices:
+            image_index[SLICING_DIMENSION] = slice_index
+
+            region.SetIndex(image_index)
+            slice_image_filter = itk.ExtractImageFilter[
+                rescaled_image, CollapsedImageType].New(
+                rescaled_image, ExtractionRegion=region)
+            slice_image_filter.SetDirectionCollapseToIdentity()
+            slice_image_filter.Update()
+
+            resampled_image = smooth_and_resample(
+                slice_image_filter.GetOutput(), width, height)
+            save_as_jpeg(resampled_image, out_dir, slice_index)
     # Generate JSON file
     generate_json(out_dir, list_indices)
 
@@ -7,12 +7,22 @@
 # -----------------------------------------------------------------------------
 
 import click
+import collections
 import ctypes
 import os
+import shutil
+
+import volume_cache
 
 __version__ = '0.1.0'
 DEFAULT_WIDTH = 512
 DEFAULT_HEIGHT = 512
+MAPPERS = ('auto', 'gpu', 'cpu-fixed-point', 'smart')
+
+# Substrings of the GL renderer description that indicate software emulation
+# (e.g. OSMesa), in which case the GPU ray caster is much slower than VTK's
+# multithreaded CPU ray caster.
+SOFTWARE_GL_RENDERERS = ('llvmpipe', 'softpipe', 'swrast', 'offscreen', 'software')
 
 # Unfortunately this hack is necessary to get the libOSMesa symbols loaded into
 # the global namespace, presumably because they are weakly linked by VTK
@@ -99,29 +109,153 @@ def setup_vr(color_fn, opacity_fn, volume_property, data):
         volume_property.ShadeOn()
 
 
-@click.command()
-@click.argument('in_file', type=click.Path(exists=True, dir_okay=True))
-@click.argument('out_dir', type=click.Path(file_okay=False))
-@click.option('--width', default=DEFAULT_WIDTH, help='output image width (px)')
-@click.option('--height', default=DEFAULT_HEIGHT, help='output image height (px)')
-@click.option('--angle-step', default=20, help='angle step for sampling (degrees)')
-@click.option('--preset', default=None, help='transfer function preset to use')
-@click.version_option(version=__version__, prog_name='Process a volume image into a 3d thumbnail')
-def process(in_file, out_dir, width, height, angle_step, preset):
-    # Importing vtk package can be quite slow, only do it if CLI validation passes
+def has_hardware_gl(window):
+    # Capabilities are only reported once a context exists
+    window.Render()
+    for line in (window.ReportCapabilities() or '').splitlines():
+        # Only look at the renderer, the vendor, version and extension list
+        # may mention unrelated "software" or "offscreen" features.
+        key, _, value = line.partition(':')
+        if key.strip().lower() == 'opengl renderer string':
+            renderer = value.lower()
+            return not any(name in renderer for name in SOFTWARE_GL_RENDERERS)
+    return False
+
+
+def create_mapper(name, window, threads=None):
+    from vtk import (
+        vtkGPUVolumeRayCastMapper, vtkFixedPointVolumeRayCastMapper, vtkSmartVolumeMapper,
+        vtkMultiThreader)
+
+    if threads:
+        # Multithreaders created from now on, including the ones owned by the
+        # CPU mapper inside vtkSmartVolumeMapper, use this many threads.
+        vtkMultiThreader.SetGlobalDefaultNumberOfThreads(threads)
+
+    hardware_gl = None
+    if name in ('auto', 'smart'):
+        hardware_gl = has_hardware_gl(window)
+
+    if name == 'auto':
+        name = 'gpu' if hardware_gl else 'cpu-fixed-point'
+
+    if name == 'gpu':
+        return vtkGPUVolumeRayCastMapper()
+    elif name == 'cpu-fixed-point':
+        mapper = vtkFixedPointVolumeRayCastMapper()
+        if threads:
+            mapper.SetNumberOfThreads(threads)
+        # Thumbnails are rendered offscreen, there is no interaction to keep responsive
+        mapper.AutoAdjustSampleDistancesOff()
+        return mapper
+    elif name == 'smart':
+        mapper = vtkSmartVolumeMapper()
+        if not hardware_gl:
+            # The smart mapper would otherwise pick the GPU path on software GL
+            mapper.SetRequestedRenderModeToRayCast()
+        return mapper
+    else:
+        raise Exception('Unknown volume mapper: %s' % name)
+
+
+def create_volume_property(preset, field_range):
     from vtk import (
-        vtkMetaImageReader, vtkGPUVolumeRayCastMapper, vtkColorTransferFunction,
-        vtkPiecewiseFunction, vtkNrrdReader, vtkVolumeProperty, vtkVolume, vtkRenderWindow,
-        vtkRenderer, vtkCamera, vtkXMLImageDataReader, vtkDICOMImageReader,
+        vtkColorTransferFunction, vtkPiecewiseFunction, vtkVolumeProperty,
         VTK_LINEAR_INTERPOLATION)
 
-    from vtk.web.dataset_builder import ImageDataSetBuilder
+    color_function = vtkColorTransferFunction()
+    scalar_opacity = vtkPiecewiseFunction()
+    volume_property = vtkVolumeProperty()
 
-    phi_vals, theta_vals = get_angle_samples(angle_step)
+    if preset is None or preset == 'default':  # some sensible naive default
+        color_function.AddRGBPoint(field_range[0], 0., 0., 0.)
+        color_function.AddRGBPoint(field_range[1], 1., 1., 1.)
+        scalar_opacity.AddPoint(field_range[0], 0.)
+        scalar_opacity.AddPoint(field_range[1], 1.)
+    elif preset in MEDICAL_XFER_PRESETS:
+        setup_vr(color_function, scalar_opacity, volume_property, MEDICAL_XFER_PRESETS[preset])
+    else:
+        raise Exception('Unknown transfer function preset: %s' % preset)
+
+    volume_property.SetInterpolationType(VTK_LINEAR_INTERPOLATION)
+    volume_property.SetColor(color_function)
+    volume_property.SetScalarOpacity(scalar_opacity)
+    return volume_property
+
+
+def visible_scalar_ranges(opacity_fn):
+    """
+    Return the (low, high) scalar intervals over which the piecewise opacity
+    function is not zero. Values beyond the first and last nodes are clamped to
+    those nodes, so an open end is represented by an infinite bound.
+    """
+    nodes = []
+    for i in range(opacity_fn.GetSize()):
+        node = [0.] * 4
+        opacity_fn.GetNodeValue(i, node)
+        nodes.append(node[:2])
+
+    if not nodes:
+        return []
+
+    ranges = []
+    if nodes[0][1] > 0:
+        ranges.append((float('-inf'), nodes[0][0]))
+    for (x0, y0), (x1, y1) in zip(nodes, nodes[1:]):
+        if y0 > 0 or y1 > 0:
+            ranges.append((x0, x1))
+    if nodes[-1][1] > 0:
+        ranges.append((nodes[-1][0], float('inf')))
+    return ranges
+
+
+def compute_visible_bounds(image, opacity_fn):
+    """
+    Compute the world bounds of the voxels that have a non-zero opacity, padded
+    by one voxel for interpolation. Returns None if the whole volume is visible
+    or nothing is, in which case the volume should be rendered as is.
+    """
+    import numpy
+    from vtk.util.numpy_support import vtk_to_numpy
+
+    scalars = image.GetPointData().GetScalars()
+    if scalars.GetNumberOfComponents() != 1:
+        return None
+
+    dims = image.GetDimensions()
+    values = vtk_to_numpy(scalars).reshape(dims[2], dims[1], dims[0])
+
+    visible = numpy.zeros(values.shape, dtype=bool)
+    for low, high in visible_scalar_ranges(opacity_fn):
+        visible |= (values >= low) & (values <= high)
+
+    extent = image.GetExtent()
+    origin = image.GetOrigin()
+    spacing = image.GetSpacing()
+    bounds = []
+    # numpy axes are (z, y, x)
+    for axis, other_axes in ((0, (0, 1)), (1, (0, 2)), (2, (1, 2))):
+        indices = numpy.nonzero(visible.any(axis=other_axes))[0]
+        if not len(indices):
+            return None
+        low = max(int(indices[0]) - 1, 0)
+        high = min(int(indices[-1]) + 1, dims[axis] - 1)
+        bounds += [origin[axis] + spacing[axis] * (extent[2 * axis] + low),
+                   origin[axis] + spacing[axis] * (extent[2 * axis] + high)]
+
+    if bounds == list(image.GetBounds()):
+        return None
+    return bounds
+
+
+def read_volume(in_file):
+    from vtk import (
+        vtkMetaImageReader, vtkNrrdReader, vtkXMLImageDataReader, vtkDICOMImageReader)
 
     if os.path.isdir(in_file):
         # If it's a directory, assume it's DICOM
         reader = vtkDICOMImageReader()
+        reader.SetDirectoryName(in_file)
     else:
         ext = os.path.splitext(in_file)[1].lower()
         if ext == '.mha':
@@ -130,64 +264,122 @@ def process(in_file, out_dir, width, height, angle_step, preset):
             reader = vtkNrrdReader()
         elif ext == '.vti':
             reader = vtkXMLImageDataReader()
-        elif ext == '.tre':
-            # TODO refactor this to reduce duplication of visualization code
-            return process_tre(in_file, out_dir, phi_vals, theta_vals, width, height)
         else:
             raise Exception('Unknown file type, cannot read: ' + in_file)
+        reader.SetFileName(in_file)
 
-    reader.SetFileName(in_file)
     reader.Update()
-    field_range = reader.GetOutput().GetPointData().GetScalars().GetRange()
+    return reader.GetOutput()
 
-    mapper = vtkGPUVolumeRayCastMapper()
-    mapper.SetInputConnection(reader.GetOutputPort())
 
-    color_function = vtkColorTransferFunction()
-    scalar_opacity = vtkPiecewiseFunction()
-    volume_property = vtkVolumeProperty()
+@click.command()
+@click.argument('in_file', type=click.Path(exists=True, dir_okay=True))
+@click.argument('out_dir', type=click.Path(file_okay=False))
+@click.option('--width', default=DEFAULT_WIDTH, help='output image width (px)')
+@click.option('--height', default=DEFAULT_HEIGHT, help='output image height (px)')
+@click.option('--angle-step', default=20, help='angle step for sampling (degrees)')
+@click.option('--preset', 'presets', multiple=True,
+              help='transfer function preset to use, may be repeated to render several presets '
+              'into per-preset subdirectories of OUT_DIR')
+@click.option('--mapper', 'mapper_name', type=click.Choice(MAPPERS), default='auto',
+              help='volume mapper to use, "auto" picks the CPU ray caster without hardware GL')
+@click.option('--threads', type=click.IntRange(min=1), default=None,
+              help='number of threads for CPU ray casting (default: all cores)')
+@click.option('--crop/--no-crop', default=True,
+              help='crop rendering to the region that is visible with each preset')
+@click.option('--cache-dir', type=click.Path(file_okay=False), default=None,
+              help='directory in which to cache decoded volumes between runs')
+@click.option('--cache-key', default=None,
+              help='content hash identifying the input (default: hash the input files)')
+@click.option('--cache-size', type=click.INT, default=volume_cache.DEFAULT_MAX_SIZE // 1024 ** 2,
+              help='maximum size of the decoded volume cache (MB)')
+@click.version_option(version=__version__, prog_name='Process a volume image into a 3d thumbnail')
+def process(in_file, out_dir, width, height, angle_step, presets, mapper_name, threads,
+            crop, cache_dir, cache_key, cache_size):
+    # Importing vtk package can be quite slow, only do it if CLI validation passes
+    from vtk import vtkVolume, vtkRenderWindow, vtkRenderer, vtkCamera
 
-    if preset is None or preset == 'default':  # some sensible naive default
-        color_function.AddRGBPoint(field_range[0], 0., 0., 0.)
-        color_function.AddRGBPoint(field_range[1], 1., 1., 1.)
-        scalar_opacity.AddPoint(field_range[0], 0.)
-        scalar_opacity.AddPoint(field_range[1], 1.)
-    elif preset in MEDICAL_XFER_PRESETS:
-        setup_vr(color_function, scalar_opacity, volume_property, MEDICAL_XFER_PRESETS[preset])
-    else:
-        raise Exception('Unknown transfer function preset: %s' % preset)
+    from vtk.web.dataset_builder import ImageDataSetBuilder
 
-    volume_property.SetInterpolationType(VTK_LINEAR_INTERPOLATION)
-    volume_property.SetColor(color_function)
-    volume_property.SetScalarOpacity(scalar_opacity)
+    # Drop duplicates, keeping the requested order
+    presets = list(collections.OrderedDict.fromkeys(presets or ('default',)))
+    for preset in presets:
+        if preset != 'default' and preset not in MEDICAL_XFER_PRESETS:
+            raise Exception('Unknown transfer function preset: %s' % preset)
 
-    volume = vtkVolume()
-    volume.SetMapper(mapper)
-    volume.SetProperty(volume_property)
+    phi_vals, theta_vals = get_angle_samples(angle_step)
+
+    if os.path.splitext(in_file)[1].lower() == '.tre':
+        # TODO refactor this to reduce duplication of visualization code
+        process_tre(in_file, os.path.join(out_dir, presets[0]), phi_vals, theta_vals,
+                    width, height)
+        # Transfer functions do not apply to tubes, every preset gets the same images
+        for preset in presets[1:]:
+            shutil.copytree(os.path.join(out_dir, presets[0]), os.path.join(out_dir, preset))
+        return
+
+    image = None
+    if cache_dir:
+        cache_key = cache_key or volume_cache.content_key(in_file)
+        image = volume_cache.load(cache_dir, cache_key)
+
+    if image is None:
+        image = read_volume(in_file)
+        if cache_dir:
+            volume_cache.store(cache_dir, cache_key, image, cache_size * 1024 ** 2)
+
+    field_range = image.GetPointData().GetScalars().GetRange()
 
     window = vtkRenderWindow()
     window.SetSize(width, height)
 
+    mapper = create_mapper(mapper_name, window, threads)
+    mapper.SetInputData(image)
+
+    volume = vtkVolume()
+    volume.SetMapper(mapper)
+
     renderer = vtkRenderer()
     window.AddRenderer(renderer)
 
     renderer.AddVolume(volume)
 
-    camera = vtkCamera()
-    renderer.SetActiveCamera(camera)
-    renderer.ResetCamera()
-    window.Render()
+    # Only the volume property differs between presets, the loaded volume and
+    # the rendering pipeline are shared.
+    for preset in presets:
+        volume_property = create_volume_property(preset, field_range)
+        volume.SetProperty(volume_property)
+
+        # The dataset builder samples around the current camera pose and leaves
+        # the camera at its last sample. Start every preset from the same pose
+        # so each image name shows the same view in all presets.
+        renderer.SetActiveCamera(vtkCamera())
+
+        # Skip the fully transparent space around the visible structures and
+        # frame the camera on what remains.
+        bounds = None
+        if crop:
+            bounds = compute_visible_bounds(image, volume_property.GetScalarOpacity())
+        if bounds:
+            mapper.CroppingOn()
+            mapper.SetCroppingRegionFlagsToSubVolume()
+            mapper.SetCroppingRegionPlanes(bounds)
+            renderer.ResetCamera(bounds)
+        else:
+            mapper.CroppingOff()
+            renderer.ResetCamera()
+        window.Render()
 
-    idb = ImageDataSetBuilder(out_dir, 'image/jpg', {
-        'type': 'spherical',
-        'phi': phi_vals,
-        'theta': theta_vals
-    })
+        idb = ImageDataSetBuilder(os.path.join(out_dir, preset), 'image/jpg', {
+            'type': 'spherical',
+            'phi': phi_vals,
+            'theta': theta_vals
+        })
 
-    idb.start(window, renderer)
+        idb.start(window, renderer)
 
-    idb.writeImages()
-    idb.stop()
+        idb.writeImages()
+        idb.stop()
 
 
 def process_tre(in_file, out_dir, phi_vals, theta_vals, width, height):
@@ -0,0 +1,167 @@
+"""
+Local, size-bounded cache of decoded volumes on worker nodes.
+
+Each entry is a directory named after the content hash of the input files that
+holds the raw scalars as a ``.npy`` file (so it can be memory-mapped back rather
+than parsed again) alongside a small JSON description of the image geometry.
+Entries are evicted least-recently-used first once the cache grows past its
+size limit; an entry's directory mtime records its last use.
+"""
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+import time
+
+DEFAULT_MAX_SIZE = 10 * 1024 ** 3  # bytes
+_SCALARS_FILE = 'scalars.npy'
+_META_FILE = 'meta.json'
+_HASH_CHUNK = 1024 ** 2
+_TMP_PREFIX = '.tmp-'
+# Temporary entries older than this were left behind by a crashed job
+_STALE_TMP_AGE = 6 * 3600  # seconds
+
+logger = logging.getLogger(__name__)
+
+
+def _iter_files(path):
+    if os.path.isdir(path):
+        for root, dirs, files in os.walk(path):
+            dirs.sort()
+            for name in sorted(files):
+                yield os.path.join(root, name)
+    else:
+        yield path
+
+
+def content_key(path):
+    """
+    Compute a cache key from the contents of a file, or of every file under a
+    directory (e.g. a DICOM series).
+    """
+    sha = hashlib.sha256()
+    for file in _iter_files(path):
+        sha.update(os.path.relpath(file, path).encode('utf8'))
+        with open(file, 'rb') as f:
+            for chunk in iter(lambda: f.read(_HASH_CHUNK), b''):
+                sha.update(chunk)
+    return sha.hexdigest()
+
+
+def _entry_size(entry):
+    return sum(os.path.getsize(os.path.join(entry, name)) for name in os.listdir(entry))
+
+
+def load(cache_dir, key):
+    """
+    Return the cached ``vtkImageData`` for ``key``, or None on a cache miss.
+    The scalars are memory-mapped from the cache rather than read into memory.
+    """
+    import numpy
+    from vtk import vtkImageData
+    from vtk.util.numpy_support import numpy_to_vtk
+
+    entry = os.path.join(cache_dir, key)
+    try:
+        with open(os.path.join(entry, _META_FILE)) as f:
+            meta = json.load(f)
+        scalars = numpy.load(os.path.join(entry, _SCALARS_FILE), mmap_mode='r')
+        # Mark as most recently used
+        os.utime(entry, None)
+    except (IOError, OSError, ValueError):
+        # Missing, or evicted by another job while being loaded
+        return None
+
+    array = numpy_to_vtk(scalars, deep=False)
+    array.SetName(meta['name'])
+
+    image = vtkImageData()
+    if 'extent' in meta:
+        image.SetExtent(meta['extent'])
+    else:
+        image.SetDimensions(meta['dimensions'])
+    image.SetSpacing(meta['spacing'])
+    image.SetOrigin(meta['origin'])
+    image.GetPointData().SetScalars(array)
+    return image
+
+
+def store(cache_dir, key, image, max_size=DEFAULT_MAX_SIZE):
+    """
+    Store a decoded ``vtkImageData`` under ``key`` and evict least recently used
+    entries until the cache fits within ``max_size`` bytes. Since the cache is
+    only an optimization, failures are logged rather than raised.
+    """
+    try:
+        _store(cache_dir, key, image, max_size)
+    except Exception:
+        logger.warning('Could not store volume %s in cache %s', key, cache_dir, exc_info=True)
+
+
+def _store(cache_dir, key, image, max_size):
+    import numpy
+    from vtk.util.numpy_support import vtk_to_numpy
+
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+
+    entry = os.path.join(cache_dir, key)
+    if os.path.isdir(entry):
+        return
+
+    scalars = image.GetPointData().GetScalars()
+    meta = {
+        'name': scalars.GetName() or 'scalars',
+        'dimensions': list(image.GetDimensions()),
+        'extent': list(image.GetExtent()),
+        'spacing': list(image.GetSpacing()),
+        'origin': list(image.GetOrigin())
+    }
+
+    # Write to a temporary directory and rename into place so concurrent jobs
+    # never observe a partially written entry.
+    tmp = tempfile.mkdtemp(dir=cache_dir, prefix=_TMP_PREFIX)
+    try:
+        numpy.save(os.path.join(tmp, _SCALARS_FILE), vtk_to_numpy(scalars))
+        with open(os.path.join(tmp, _META_FILE), 'w') as f:
+            json.dump(meta, f)
+        os.rename(tmp, entry)
+    except Exception:
+        shutil.rmtree(tmp, ignore_errors=True)
+        # Another job may have stored the same entry first
+        if not os.path.isdir(entry):
+            raise
+
+    evict(cache_dir, max_size, keep=key)
+
+
+def evict(cache_dir, max_size, keep=None):
+    entries = []
+    now = time.time()
+    for name in os.listdir(cache_dir):
+        path = os.path.join(cache_dir, name)
+        if name.startswith(_TMP_PREFIX):
+            try:
+                if now - os.path.getmtime(path) > _STALE_TMP_AGE:
+                    shutil.rmtree(path, ignore_errors=True)
+            except OSError:
+                pass
+            continue
+        if name.startswith('.') or not os.path.isdir(path):
+            continue
+        try:
+            entries.append((os.path.getmtime(path), name, _entry_size(path)))
+        except OSError:
+            # Removed by another job while scanning
+            continue
+
+    total = sum(e[2] for e in entries)
+    for _, name, size in sorted(entries):
+        if total <= max_size:
+            break
+        if name == keep:
+            continue
+        shutil.rmtree(os.path.join(cache_dir, name), ignore_errors=True)
+        total -= size